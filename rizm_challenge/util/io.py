@@ -1,15 +1,60 @@
 """Mainly code to read the input data."""
+import concurrent.futures
+import csv
 import warnings
 import pathlib
 
 import pandas as pd
 
+try:
+    # Optional, multithreaded native csv parser
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa_csv = None
+
+
+def _parse_time_index(index: pd.Index) -> pd.DatetimeIndex:
+    """Parse timestamps as given, i.e. naive stay naive and UTC offsets are kept.
+
+    Only mixed UTC offsets (e.g. across DST) don't fit one index -> converted to UTC.
+    """
+    try:
+        with warnings.catch_warnings():
+            # pandas warns about mixed offsets before returning an object index
+            warnings.simplefilter("ignore", FutureWarning)
+            parsed = pd.to_datetime(index)
+    except ValueError:
+        parsed = None
+
+    if not isinstance(parsed, pd.DatetimeIndex):
+        parsed = pd.to_datetime(index, utc=True)
+
+    return parsed
+
 
 def _read_ts(file_name: pathlib.Path, col_name:str):
     # TODO checkout read with multi-columns names to get 
     # (and autmatically check) unit.
     # But everything is MW -> fine for now.
-    df = pd.read_csv(file_name, index_col=0, skiprows=[1], parse_dates=True)
+    if pa_csv is not None:
+        # Keep time column as text, pyarrow would convert timestamps with offsets to UTC
+        with open(file_name, newline="") as file:
+            time_col = next(csv.reader(file))[0]
+
+        # Second row holds the units -> skip it (pandas' pyarrow engine can't)
+        table = pa_csv.read_csv(
+            str(file_name),
+            read_options=pa_csv.ReadOptions(skip_rows_after_names=1),
+            convert_options=pa_csv.ConvertOptions(column_types={time_col: pa.string()}),
+        )
+        df = table.to_pandas()
+        df = df.set_index(time_col)
+    else:
+        df = pd.read_csv(file_name, index_col=0, skiprows=[1])
+
+    # Timestamps are parsed the same way for both parsers
+    df.index = _parse_time_index(df.index)
     df = df.rename(columns={"value": col_name})
 
     return df
@@ -20,12 +65,13 @@ def _repair_data(ts: pd.DataFrame):
     This is specific to the given data here. Needs to be extended depending on the data.
     E.g. to handle nans in the middle better if a state exists.
     """
-    nan_indices = ts.index[ts.isna().any(axis=1)]
+    valid = ts.notna().all(axis=1).to_numpy()
+    n_invalid = len(valid) - valid.sum()
 
-    if len(nan_indices) > 0:
-        warnings.warn(f"Removing {len(nan_indices)} from input data because of inconsistent data")
+    if n_invalid > 0:
+        warnings.warn(f"Removing {n_invalid} from input data because of inconsistent data")
 
-    return ts[~ts.isna().any(axis=1)]
+    return ts.iloc[valid]
 
 
 def _read_parameters(parameter_file_name: pathlib.Path):
@@ -35,24 +81,33 @@ def _read_parameters(parameter_file_name: pathlib.Path):
     effs = parameters.loc[parameters["parameter_type"] == "efficiency", "value"]
     caps = parameters.loc[parameters["parameter_type"] == "capacity", "value"]
 
-    caps.loc["photovoltaic"] /= 1000.0  # transform kW -> MW (in a hacky way for now)
-    effs /= 100.0  # transform to fraction (in a hacky way)
+    # Plain dicts -> scalar lookups downstream don't go through pandas indexing
+    caps = caps.astype(float).to_dict()
+    effs = (effs.astype(float) / 100.0).to_dict()  # transform to fraction (in a hacky way)
+
+    caps["photovoltaic"] /= 1000.0  # transform kW -> MW (in a hacky way for now)
 
     return {"cap": caps, "eff": effs}
 
 
-def get_input(data_path: pathlib.Path) -> tuple[pd.DataFrame, dict[str, pd.Series]]:
+def get_input(
+    data_path: pathlib.Path,
+) -> tuple[pd.DataFrame, dict[str, dict[str, float]]]:
     """Read input data and return parameters and time series data."""
 
-    ts = pd.concat(
-        [
-            _read_ts(data_path / ts_file, col_name)
-            for ts_file, col_name in zip(
-                ["electricity_demand.csv", "heat_demand.csv", "photovoltaic_availability.csv"],
-                ["load_el", "load_th", "pv_avail"]
-            )
-        ], axis=1
-    )
+    ts_files = ["electricity_demand.csv", "heat_demand.csv", "photovoltaic_availability.csv"]
+    col_names = ["load_el", "load_th", "pv_avail"]
+
+    ts_paths = [data_path / ts_file for ts_file in ts_files]
+
+    if pa_csv is not None:
+        # pyarrow releases the GIL while parsing -> read files concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ts_files)) as executor:
+            ts_list = list(executor.map(_read_ts, ts_paths, col_names))
+    else:
+        ts_list = [_read_ts(path, col_name) for path, col_name in zip(ts_paths, col_names)]
+
+    ts = pd.concat(ts_list, axis=1)
 
     ts = _repair_data(ts)
     parameters = _read_parameters(data_path / "parameter.csv")
@@ -1,5 +1,10 @@
 import dataclasses
-import datetime
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import warnings
 import pandas as pd
 import numpy as np
 import casadi as cas
@@ -9,32 +14,46 @@ from matplotlib import pyplot as plt
 
 
 SOLVER_NAME = "qpoases"
+N_THREADS = os.cpu_count() or 1  # threads used to solve the independent windows
+# Each thread's solver instance is called for a sequence of windows -> qpOASES hot-starts
+# from the active set of its previous window, which hardly differs between windows
+# Note: qpOASES is kept in its default dense mode, for a problem of this size (120
+# variables, 48 constraint rows) no external sparse linear solver is needed. This also
+# keeps the mapped function free of external linear solvers that aren't thread-safe.
+SOLVER_OPTIONS = {
+    "hessian_type": "zero",  # objective is linear (LP)
+    "enableEqualities": True,
+    # Failures are detected from the returned schedules, see `_solve`
+    "error_on_fail": False,
+}
+
+SLACK_TOL = 1e-9  # slack (MW) above this counts as unsatisfied heat load
 
 
 @dataclasses.dataclass
 class OptVariables:
     """Container to store optimization variables."""
 
-    p_el_gt: cas.MX  # electric (output) power of gas turbines
-    p_el_boiler_el: cas.MX  # electric power of electric boiler
-    p_th_boiler_gas: cas.MX  # thermal (output) power of gas boiler
-    p_el_pv: cas.MX  # electric (output) power of PV generator
-    slack_th: cas.MX  # slack variable to assert feasibility
+    p_el_gt: cas.SX  # electric (output) power of gas turbines
+    p_el_boiler_el: cas.SX  # electric power of electric boiler
+    p_th_boiler_gas: cas.SX  # thermal (output) power of gas boiler
+    p_el_pv: cas.SX  # electric (output) power of PV generator
+    slack_th: cas.SX  # slack variable to assert feasibility
 
 
 @dataclasses.dataclass
 class OptData:
     """Container to store parameters of optimization problem."""
 
-    load_el: cas.MX  # electric load to e satisfied
-    load_th: cas.MX  # thermal load to be satisfied
-    pv_avail: cas.MX  # availability of PV
-    gas_price: cas.MX  # price time series of gas
+    load_el: cas.SX  # electric load to e satisfied
+    load_th: cas.SX  # thermal load to be satisfied
+    pv_avail: cas.SX  # availability of PV
+    gas_price: cas.SX  # price time series of gas
 
 
 def solve_problem(
     time_series: pd.DataFrame,
-    system_parameters: dict[str, pd.Series],
+    system_parameters: dict[str, dict[str, float]],
     plot_on_fail=True,
 ):
     """Setup problem and solve.
@@ -45,45 +64,43 @@ def solve_problem(
     time_series["gas_price"] = 35.
 
     horizon = 24
-    window = (horizon - 1) * datetime.timedelta(hours=1)
 
     col_names_opt_vars = list(OptVariables.__dataclass_fields__.keys())
-    schedules_ts = pd.DataFrame(
-        index=time_series.index, columns=col_names_opt_vars + ["success"]
-    )
-    objective = 0
-
-    # Set up OCP once at the beginning and reuse
-    ocp, opt_vars, opt_pars = _formulate_ocp(system_parameters, horizon)
 
-    # No state and connection between time steps -> can be solved in parts and glued together
-    for start in time_series.index[::horizon]:
-        current_ts = time_series.loc[start : start + window, :]
-        # Solve current subproblem
-        _schedules, success = _solve(ocp, opt_vars, opt_pars, current_ts)
+    # Set up OCP once at the beginning (or load from cache) and reuse as a single function
+    mpc_fn = _load_or_formulate_ocp(system_parameters, horizon)
 
-        objective += _objective_expression(
-            _schedules, system_parameters["eff"], slack_penalty=0.0
-        )
+    # No state and connection between time steps -> all parts are solved in one call
+    # and glued together
+    _schedules, success = _solve(mpc_fn, time_series, horizon)
 
-        # store schedules (optimal solution) in time series
-        for col_name in col_names_opt_vars:
-            schedules_ts.loc[start : start + window, col_name] = getattr(
-                _schedules, col_name
-            )
+    objective = _operating_costs(
+        _schedules, system_parameters["eff"], time_series["gas_price"].to_numpy()
+    )
 
-        schedules_ts.loc[start : start + window, "success"] = success
+    # store schedules (optimal solution) in time series
+    schedules = np.empty((len(time_series), len(col_names_opt_vars)), dtype=np.float64)
+    for i, col_name in enumerate(col_names_opt_vars):
+        schedules[:, i] = getattr(_schedules, col_name)
 
-        if not success and plot_on_fail:
-            _plot_and_show(
-                schedules_ts.loc[start : start + window],
-                current_ts,
-                system_parameters["eff"],
-            )
+    schedules_ts = pd.DataFrame(
+        schedules, index=time_series.index, columns=col_names_opt_vars
+    )
+    # success per window -> per time step
+    schedules_ts["success"] = np.repeat(success, horizon)[: len(time_series)]
+
+    # Draw all failed windows at once, successful time steps are masked (gaps in plot)
+    if plot_on_fail and not success.all():
+        failed = ~schedules_ts["success"]
+        _plot_and_show(
+            schedules_ts.where(failed),
+            time_series.where(failed),
+            system_parameters["eff"],
+        )
 
     # Make some basic results analysis
     _plot_and_show(schedules_ts, time_series, system_parameters["eff"])
-    ind_slack = schedules_ts.index[schedules_ts["slack_th"] > 0.0]
+    ind_slack = schedules_ts.index[schedules_ts["slack_th"] > SLACK_TOL]
     print(
         f"Heat load could not be satisfied in these time instances: {list(ind_slack)}."
         f" Overall {schedules_ts['slack_th'][ind_slack].sum():0.04f} MWh where not supplied."
@@ -96,8 +113,8 @@ def solve_problem(
 
 def _objective_expression(
     x: OptVariables,
-    effs: pd.Series,
-    price_gas: float | np.ndarray | cas.MX = 35,
+    effs: dict[str, float],
+    price_gas: float | np.ndarray | cas.SX = 35,
     dt_h: float = 1,
     slack_penalty: float = 1000.0,
 ):
@@ -113,97 +130,228 @@ def _objective_expression(
     )
 
 
-def _formulate_ocp(system_parameters: dict[str, pd.Series], horizon: int):
-    """Return formulated ocp."""
+def _operating_costs(
+    x: OptVariables,
+    effs: dict[str, float],
+    price_gas: float | np.ndarray = 35,
+    dt_h: float = 1,
+) -> float:
+    """Evaluate gas costs of solved schedules (objective without slack) on numpy arrays."""
+
+    return float(
+        np.sum(
+            (x.p_el_gt / effs["gasturbine"] + x.p_th_boiler_gas / effs["gasboiler"])
+            * dt_h
+            * price_gas
+        )
+    )
+
+
+def _formulate_ocp(
+    system_parameters: dict[str, dict[str, float]], horizon: int
+) -> cas.Function:
+    """Return formulated ocp as function mapping external data to schedules."""
 
     caps = system_parameters["cap"]
     effs = system_parameters["eff"]
 
-    ocp = cas.Opti("conic")
-    ocp.solver(SOLVER_NAME)
+    par_names = list(OptData.__dataclass_fields__.keys())
+    var_names = list(OptVariables.__dataclass_fields__.keys())
 
     # Define external data
-    ext_data = OptData(
-        load_el=ocp.parameter(horizon),
-        load_th=ocp.parameter(horizon),
-        pv_avail=ocp.parameter(horizon),
-        gas_price=ocp.parameter(horizon),
-    )
+    ext_data = OptData(*(cas.SX.sym(name, horizon) for name in par_names))
 
     # Define optimization variables
-    x = OptVariables(
-        p_el_gt=ocp.variable(horizon),
-        p_el_boiler_el=ocp.variable(horizon),
-        p_th_boiler_gas=ocp.variable(horizon),
-        p_el_pv=ocp.variable(horizon),
-        slack_th=ocp.variable(horizon),
+    x = OptVariables(*(cas.SX.sym(name, horizon) for name in var_names))
+
+    # Define bounds for optimization variables, per time step
+    # (simple bounds instead of constraint rows, also if depending on external data)
+    lbx = OptVariables(*(cas.DM.zeros(horizon) for _ in var_names))
+    ubx = OptVariables(
+        p_el_gt=cas.DM(np.full(horizon, caps["gasturbine"])),
+        p_el_boiler_el=cas.DM(np.full(horizon, caps["electricboiler"])),
+        p_th_boiler_gas=cas.DM(np.full(horizon, caps["gasboiler"])),
+        p_el_pv=ext_data.pv_avail * caps["photovoltaic"],
+        slack_th=ext_data.load_th,
     )
 
-    # Define bounds for optimization variables
-    ocp.subject_to(x.p_el_gt >= 0.0)
-    ocp.subject_to(x.p_el_gt <= caps["gasturbine"])
+    # Constraints as (row of matrix blocks, lower bound, upper bound), blocks ordered as
+    # the optimization variables. All blocks are diagonal -> one row per time step.
+    eye = cas.DM.eye(horizon)
+    zero = cas.DM(horizon, horizon)
 
-    ocp.subject_to(x.p_el_boiler_el >= 0.0)
-    ocp.subject_to(x.p_el_boiler_el <= caps["electricboiler"])
+    # Define both energy conservation constraints
+    constraints = [
+        # ... electrical
+        ([eye, -eye, zero, eye, zero], ext_data.load_el, ext_data.load_el),
+        # ... and thermal
+        (
+            [zero, effs["electricboiler"] * eye, eye, zero, eye],
+            ext_data.load_th,
+            ext_data.load_th,
+        ),
+    ]
+    a = cas.blockcat([row for row, _, _ in constraints])
+
+    # Objective is linear -> only its (data dependent) gradient enters the QP
+    x_vec = cas.vertcat(*(getattr(x, name) for name in var_names))
+    objective = _objective_expression(x, effs, price_gas=ext_data.gas_price)
+    qp_data = cas.Function(
+        "qp_data",
+        [getattr(ext_data, name) for name in par_names],
+        [
+            cas.gradient(objective, x_vec),
+            cas.vertcat(*(lb for _, lb, _ in constraints)),
+            cas.vertcat(*(ub for _, _, ub in constraints)),
+            cas.vertcat(*(getattr(ubx, name) for name in var_names)),
+        ],
+    )
 
-    ocp.subject_to(x.p_th_boiler_gas >= 0.0)
-    ocp.subject_to(x.p_th_boiler_gas <= caps["gasboiler"])
+    # Pass sparsity patterns explicitly (zero Hessian, block diagonal constraints)
+    solver = cas.conic(
+        "mpc_qp",
+        SOLVER_NAME,
+        {"h": cas.Sparsity(x_vec.numel(), x_vec.numel()), "a": a.sparsity()},
+        SOLVER_OPTIONS,
+    )
 
-    ocp.subject_to(x.p_el_pv >= 0)
-    ocp.subject_to(x.p_el_pv <= ext_data.pv_avail * caps["photovoltaic"])
+    # Wrap solver to map external data directly to the (split) schedules
+    # (MX only for this thin call node, the QP data itself stays SX)
+    pars = [cas.MX.sym(name, horizon) for name in par_names]
+    g, lba, uba, ubx_vec = qp_data(*pars)
+    solution = solver(
+        g=g,
+        a=a,
+        lba=lba,
+        uba=uba,
+        lbx=cas.vertcat(*(getattr(lbx, name) for name in var_names)),
+        ubx=ubx_vec,
+    )
 
-    ocp.subject_to(x.slack_th >= 0)
-    ocp.subject_to(x.slack_th <= ext_data.load_th)
+    # Note: not compiled to C via `generate` / `external`, qpOASES does not support
+    # CasADi code generation and the remaining (affine) expressions are cheap.
+    return cas.Function(
+        "mpc", pars, cas.vertsplit(solution["x"], horizon), par_names, var_names
+    )
 
-    # Define both energy conservation constraints
-    # ... electrical
-    ocp.subject_to(x.p_el_gt + x.p_el_pv == ext_data.load_el + x.p_el_boiler_el)
-    # ... and thermal
-    ocp.subject_to(
-        x.p_el_boiler_el * effs["electricboiler"] + x.p_th_boiler_gas
-        == ext_data.load_th - x.slack_th
+
+def _load_or_formulate_ocp(
+    system_parameters: dict[str, dict[str, float]], horizon: int
+) -> cas.Function:
+    """Return cached ocp function if problem is unchanged, otherwise formulate and cache it."""
+
+    # Problem shape, data and solver setup as well as this code (and the CasADi version
+    # used for serialization) define the function
+    key = json.dumps(
+        [
+            cas.__version__,
+            horizon,
+            system_parameters,
+            SOLVER_NAME,
+            SOLVER_OPTIONS,
+            hashlib.sha256(pathlib.Path(__file__).read_bytes()).hexdigest(),
+        ],
+        sort_keys=True,
     )
+    file_name = f"mpc_{horizon}_{hashlib.sha256(key.encode()).hexdigest()[:16]}.casadi"
 
-    ocp.minimize(_objective_expression(x, effs, price_gas=ext_data.gas_price))
+    # Cache is optional -> any problem with it only results in a warning
+    try:
+        cache_dir = _cache_dir()
+    except RuntimeError:
+        warnings.warn("No cache directory available, formulated ocp is not cached")
+        return _formulate_ocp(system_parameters, horizon)
+
+    cache_file = cache_dir / file_name
+    try:
+        if cache_file.exists():
+            return cas.Function.load(str(cache_file))
+    except (OSError, RuntimeError):
+        warnings.warn(f"Could not load cached ocp {cache_file}, formulating it again")
+
+    mpc_fn = _formulate_ocp(system_parameters, horizon)
+
+    try:
+        # Write to temporary file and move it in place -> no partially written files
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=cache_dir, suffix=".casadi.tmp")
+        os.close(fd)
+        try:
+            mpc_fn.save(tmp_name)
+            os.replace(tmp_name, cache_file)
+        finally:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+
+        # Only keep the latest function per horizon, older ones belong to changed
+        # parameters / code and would otherwise pile up
+        for stale_file in cache_dir.glob(f"mpc_{horizon}_*.casadi"):
+            if stale_file != cache_file:
+                stale_file.unlink(missing_ok=True)
+    except (OSError, RuntimeError) as err:
+        warnings.warn(f"Could not cache formulated ocp in {cache_dir}: {err}")
+
+    return mpc_fn
+
+
+def _cache_dir() -> pathlib.Path:
+    """Return directory to cache formulated ocp functions in (XDG cache dir if set)."""
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME")
+    if xdg_cache_home:
+        return pathlib.Path(xdg_cache_home) / "rizm"
 
-    return ocp, x, ext_data
+    return pathlib.Path.home() / ".cache" / "rizm"
+
+
+def _to_windows(values: np.ndarray, horizon: int) -> np.ndarray:
+    """Reshape time series to one window per column, last window padded with zeros."""
+    n_windows = -(-len(values) // horizon)
+    padded = np.zeros(n_windows * horizon, dtype=np.float64)
+    padded[: len(values)] = values
+
+    # Transposed view is Fortran-contiguous float64, i.e. matches CasADi's column-major
+    # storage and can be copied into a DM as one block
+    return padded.reshape(n_windows, horizon).T
 
 
 def _solve(
-    ocp: cas.Opti, opt_vars: OptVariables, opt_pars: OptData, ts_in
-) -> tuple[OptVariables, bool]:
+    mpc_fn: cas.Function, ts_in: pd.DataFrame, horizon: int
+) -> tuple[OptVariables, np.ndarray]:
+    """Solve all windows of `ts_in` with one mapped, multithreaded call of `mpc_fn`.
 
-    ocp.set_value(opt_pars.load_el, ts_in["load_el"])
-    ocp.set_value(opt_pars.load_th, ts_in["load_th"])
-    ocp.set_value(opt_pars.pv_avail, ts_in["pv_avail"])
-    ocp.set_value(opt_pars.gas_price, ts_in["gas_price"])
+    Return schedules glued together and the success flag of each window.
+    """
+    par_names = list(OptData.__dataclass_fields__.keys())
+    windows = OptData(
+        *(_to_windows(ts_in[name].to_numpy(dtype=np.float64), horizon) for name in par_names)
+    )
+    n_windows = windows.load_el.shape[1]
 
-    try:
-        solution = ocp.solve()
-        result = OptVariables(
-            p_el_gt=solution.value(opt_vars.p_el_gt),
-            p_el_boiler_el=solution.value(opt_vars.p_el_boiler_el),
-            p_th_boiler_gas=solution.value(opt_vars.p_th_boiler_gas),
-            p_el_pv=solution.value(opt_vars.p_el_pv),
-            slack_th=solution.value(opt_vars.slack_th),
+    # Costs don't depend on the number of threads. If a window's LP has several optimal
+    # schedules, which one is returned may (via the hot-start sequence) depend on it.
+    solution = mpc_fn.map(n_windows, "thread", min(N_THREADS, n_windows))(
+        *(getattr(windows, name) for name in par_names)
+    )
+    result = OptVariables(*(np.asarray(value) for value in solution))
+
+    # Electric balance has no slack -> if violated, the solver failed (infeasible problem)
+    balanced = np.isclose(
+        result.p_el_gt + result.p_el_pv, windows.load_el + result.p_el_boiler_el
+    ).all(axis=0)
+    success = balanced & ~np.any(result.slack_th > SLACK_TOL, axis=0)
+
+    # Columns are consecutive windows -> flatten column-wise and drop padding
+    schedules = OptVariables(
+        *(
+            getattr(result, field.name).ravel(order="F")[: len(ts_in)]
+            for field in dataclasses.fields(result)
         )
+    )
 
-        return result, (result.slack_th == 0).all()
-    except RuntimeError:
-        # Infeasible problem
-        ts_in.plot()
-        plt.show()
-        result = OptVariables(
-            p_el_gt=ocp.debug.value(opt_vars.p_el_gt),
-            p_el_boiler_el=ocp.debug.value(opt_vars.p_el_boiler_el),
-            p_th_boiler_gas=ocp.debug.value(opt_vars.p_th_boiler_gas),
-            p_el_pv=ocp.debug.value(opt_vars.p_el_pv),
-            slack_th=ocp.debug.value(opt_vars.slack_th),
-        )
-        return result, False
+    return schedules, success
 
 
-def _plot_and_show(x: pd.DataFrame, ext_data: pd.DataFrame, effs: pd.Series):
+def _plot_and_show(x: pd.DataFrame, ext_data: pd.DataFrame, effs: dict[str, float]):
     """Make some plots to sanity check (intermediate) results."""
     index = ext_data.index
 